@@ -3,8 +3,6 @@ from concurrent.futures import ThreadPoolExecutor
 
 from amplitude import Amplitude, BaseEvent, EventOptions
 
-from config import config
-
 
 Event = TypeVar("Event", bound=BaseEvent)
 
@@ -30,9 +28,6 @@ class Ampli:
         self.client.shutdown()
 
 
-amplitude = Ampli(api_key=config.amplitude_api_key)
-
-
 class UserRegistrationEvent(BaseEvent):
     def __init__(self):
         super().__init__(event_type="User Registration")
@@ -60,4 +55,12 @@ class PhotoRecognitionEvent(BaseEvent):
 
 class ValueValidationEvent(BaseEvent):
     def __init__(self):
-        super().__init__(event_type="Value Validation")
\ No newline at end of file
+        super().__init__(event_type="Value Validation")
+
+
+class CircuitBreakerStateEvent(BaseEvent):
+    def __init__(self, endpoint: str, state: str):
+        super().__init__(
+            event_type="OpenAI Circuit Breaker State",
+            event_properties={"endpoint": endpoint, "state": state}
+        )
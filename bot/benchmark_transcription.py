@@ -0,0 +1,58 @@
+"""Сравнение задержки локального и удаленного распознавания голоса.
+
+Usage: python bot/benchmark_transcription.py voice_1.ogg voice_2.ogg --runs 5
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+import transcription
+from config import config
+from container import container
+
+
+async def benchmark(backend: transcription.TranscriptionBackend, paths: list[str], runs: int, language: str):
+    for path in paths:
+        latencies = []
+        for _ in range(runs):
+            started_at = time.perf_counter()
+            await backend.transcribe(voice_path=path, language=language)
+            latencies.append(time.perf_counter() - started_at)
+        print(
+            f"{backend.name:>6} | {path} | median {statistics.median(latencies):.3f}s | "
+            f"min {min(latencies):.3f}s | max {max(latencies):.3f}s"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--language", default="ru")
+    args = parser.parse_args()
+
+    backends: list[transcription.TranscriptionBackend] = [
+        transcription.OpenAIWhisperBackend(client=container.openai_client)
+    ]
+    if transcription.is_local_whisper_installed():
+        # warm up the pool so that model loading is not counted as latency
+        local = transcription.LocalWhisperBackend(
+            executor=container.local_whisper_executor,
+            max_in_flight=config.local_whisper_workers
+        )
+        await local.transcribe(voice_path=args.paths[0], language=args.language)
+        backends.append(local)
+    else:
+        print("faster-whisper is not installed, benchmarking the API only")
+
+    print(f"local model: {config.local_whisper_model}, runs per file: {args.runs}")
+    try:
+        for backend in backends:
+            await benchmark(backend=backend, paths=args.paths, runs=args.runs, language=args.language)
+    finally:
+        await container.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+import time
+import hashlib
+import logging
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from container import container
+
+
+class VoiceAssetCache:
+    """Кэш telegram file_id уже отправленных голосовых ответов, чтобы не озвучивать один и тот же текст заново"""
+
+    key_prefix = "voice_asset"
+    ttl_seconds = 60 * 60 * 24 * 30
+
+    def __init__(self, redis: Optional[Redis] = None):
+        self.redis = redis or container.redis
+
+    async def get_file_id(self, text: str, voice: str, model: str) -> Optional[str]:
+        try:
+            file_id = await self.redis.get(self._key(text=text, voice=voice, model=model))
+        except RedisError as e:
+            logging.warning(f"Voice asset cache is unavailable: {e}")
+            return
+        return file_id.decode() if file_id else None
+
+    async def save_file_id(self, text: str, voice: str, model: str, file_id: str):
+        try:
+            await self.redis.set(self._key(text=text, voice=voice, model=model), file_id, ex=self.ttl_seconds)
+        except RedisError as e:
+            logging.warning(f"Voice asset cache is unavailable: {e}")
+
+    async def delete(self, text: str, voice: str, model: str):
+        try:
+            await self.redis.delete(self._key(text=text, voice=voice, model=model))
+        except RedisError as e:
+            logging.warning(f"Voice asset cache is unavailable: {e}")
+
+    def _key(self, text: str, voice: str, model: str) -> str:
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        return f"{self.key_prefix}:{model}:{voice}:{text_hash}"
+
+
+class TranscriptionCache:
+    """Кэш распознанного текста голосовых, пересланные и повторные голосовые не скачиваются и не распознаются заново"""
+
+    key_prefix = "transcription"
+    index_key = "transcription:index"
+    ttl_seconds = 60 * 60 * 24 * 7
+    max_entries = 50_000
+    max_text_length = 4096
+
+    def __init__(self, redis: Optional[Redis] = None):
+        self.redis = redis or container.redis
+
+    async def get(self, file_unique_id: str, duration: int) -> Optional[str]:
+        try:
+            text = await self.redis.get(self._key(file_unique_id=file_unique_id, duration=duration))
+        except RedisError as e:
+            logging.warning(f"Transcription cache is unavailable: {e}")
+            return
+        return text.decode() if text is not None else None
+
+    async def save(self, file_unique_id: str, duration: int, text: str):
+        if len(text) > self.max_text_length:
+            return
+        key = self._key(file_unique_id=file_unique_id, duration=duration)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(key, text, ex=self.ttl_seconds)
+                pipe.zadd(self.index_key, {key: time.time()})
+                pipe.zremrangebyscore(self.index_key, "-inf", time.time() - self.ttl_seconds)
+                pipe.zcard(self.index_key)
+                *_, entries = await pipe.execute()
+            if entries > self.max_entries:
+                await self._evict_oldest(count=entries - self.max_entries)
+        except RedisError as e:
+            logging.warning(f"Transcription cache is unavailable: {e}")
+
+    async def _evict_oldest(self, count: int):
+        evicted = await self.redis.zpopmin(self.index_key, count)
+        if evicted:
+            await self.redis.delete(*(key for key, _ in evicted))
+
+    def _key(self, file_unique_id: str, duration: int) -> str:
+        return f"{self.key_prefix}:{file_unique_id}:{duration}"
@@ -14,6 +14,13 @@ class Settings(BaseSettings):
     storage_dir: str = str(Path(__file__).parent.parent / "storage")
     documents_file_search_dir: str = str(Path(__file__).parent / "documents")
 
+    # requires `faster-whisper` to be installed
+    local_whisper_enabled: bool = Field(False, env="LOCAL_WHISPER_ENABLED")
+    local_whisper_model: str = Field("small", env="LOCAL_WHISPER_MODEL")
+    local_whisper_max_duration: int = Field(10, env="LOCAL_WHISPER_MAX_DURATION")
+    local_whisper_workers: int = Field(1, env="LOCAL_WHISPER_WORKERS")
+    local_whisper_cpu_threads: int = Field(4, env="LOCAL_WHISPER_CPU_THREADS")
+
     REDIS_HOST: str = Field(..., env="REDIS_HOST")
     REDIS_PORT: int = Field(..., env="REDIS_PORT")
 
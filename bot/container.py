@@ -0,0 +1,111 @@
+import logging
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from config import config
+
+if TYPE_CHECKING:
+    from aiogram import Bot, Dispatcher
+    from openai import AsyncOpenAI
+    from redis.asyncio import Redis
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+    from ampli import Ampli
+    from rate_limit import OpenAIRateLimiter
+    from scheduler import WorkScheduler
+
+
+class AppContainer:
+    """Контейнер приложения: клиенты создаются при первом обращении, а не при импорте модулей"""
+
+    local_whisper_disabled = False
+
+    @cached_property
+    def openai_client(self) -> "AsyncOpenAI":
+        from resilience import create_openai_client
+        return create_openai_client()
+
+    @cached_property
+    def amplitude(self) -> "Ampli":
+        from ampli import Ampli
+        return Ampli(api_key=config.amplitude_api_key)
+
+    @cached_property
+    def redis(self) -> "Redis":
+        from redis.asyncio import Redis
+        return Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
+
+    @cached_property
+    def rate_limiter(self) -> "OpenAIRateLimiter":
+        from rate_limit import OpenAIRateLimiter
+        return OpenAIRateLimiter(redis=self.redis)
+
+    @cached_property
+    def db_engine(self) -> "AsyncEngine":
+        from sqlalchemy.ext.asyncio import create_async_engine
+        return create_async_engine(url=config.db_url, echo=False)
+
+    @cached_property
+    def db_session(self) -> "async_sessionmaker[AsyncSession]":
+        from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+        return async_sessionmaker(self.db_engine, class_=AsyncSession, expire_on_commit=True)
+
+    @cached_property
+    def local_whisper_executor(self) -> ProcessPoolExecutor:
+        import multiprocessing
+        from transcription import init_local_model
+        return ProcessPoolExecutor(
+            max_workers=config.local_whisper_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_local_model,
+            initargs=(config.local_whisper_model, config.local_whisper_cpu_threads)
+        )
+
+    @property
+    def is_local_whisper_enabled(self) -> bool:
+        from transcription import is_local_whisper_installed
+        return config.local_whisper_enabled and not self.local_whisper_disabled and is_local_whisper_installed()
+
+    def disable_local_whisper(self):
+        # a broken pool stays broken, most likely the model failed to load in the worker initializer
+        if self.local_whisper_disabled:
+            return
+        logging.error("Local whisper process pool is broken, local transcription is disabled")
+        self.local_whisper_disabled = True
+        executor = self.__dict__.pop("local_whisper_executor", None)
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @cached_property
+    def scheduler(self) -> "WorkScheduler":
+        from scheduler import WorkScheduler
+        return WorkScheduler()
+
+    @cached_property
+    def bot(self) -> "Bot":
+        from aiogram import Bot
+        return Bot(token=config.telegram_api_token)
+
+    @cached_property
+    def dispatcher(self) -> "Dispatcher":
+        from aiogram import Dispatcher
+        from aiogram.fsm.storage.redis import RedisStorage
+        return Dispatcher(bot=self.bot, storage=RedisStorage(redis=self.redis))
+
+    async def close(self):
+        # only clients that were actually built are closed
+        built = self.__dict__
+        if "openai_client" in built:
+            await self.openai_client.close()
+        if "db_engine" in built:
+            await self.db_engine.dispose()
+        if "redis" in built:
+            await self.redis.aclose()
+        if "local_whisper_executor" in built:
+            self.local_whisper_executor.shutdown(wait=False, cancel_futures=True)
+        if "amplitude" in built:
+            self.amplitude.shutdown()
+
+
+container = AppContainer()
@@ -1,11 +1,8 @@
-from sqlalchemy import BigInteger, ARRAY, String
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs, AsyncSession
-
-from bot.config import config
+from datetime import datetime
 
-async_engine = create_async_engine(url=config.db_url, echo=False)
-async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=True)
+from sqlalchemy import BigInteger, ARRAY, String, DateTime, func
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncEngine
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -18,12 +15,27 @@ class User(Base):
     telegram_id: Mapped[BigInteger] = mapped_column(BigInteger, index=True, unique=True, nullable=False)
     thread_id: Mapped[str] = mapped_column(unique=True, nullable=True)
     values: Mapped[list[str]] = mapped_column(ARRAY(String), nullable=True)
+    thread_message_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    # prompt tokens of the latest run, i.e. the current context size of the thread, not a running total
+    thread_tokens: Mapped[int] = mapped_column(default=0, server_default="0")
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        # unlike now(), clock_timestamp() is not frozen at the start of a long transaction
+        server_default=func.clock_timestamp(),
+        onupdate=func.clock_timestamp()
+    )
+    # set only when values change, thread usage updates must not put the user into the next export
+    values_updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        index=True,
+        server_default=func.clock_timestamp()
+    )
 
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id})>"
 
 
-async def create_table():
-    async with async_engine.begin() as conn:
+async def create_table(engine: AsyncEngine):
+    async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
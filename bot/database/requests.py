@@ -1,12 +1,14 @@
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional, Sequence
 
-from sqlalchemy import select
+from sqlalchemy import Row, func, select, update
 
+from container import container
 from . import models
 
 
 async def create_user_if_not_exists(**kwargs):
-    async with models.async_session() as session:
+    async with container.db_session() as session:
         stmt = select(models.User).filter_by(**kwargs)
         user: Optional[models.User] = await session.scalar(stmt)
         created = False
@@ -20,14 +22,14 @@ async def create_user_if_not_exists(**kwargs):
 
 
 async def get_user_by_telegram_id(telegram_id: int):
-    async with models.async_session() as session:
+    async with container.db_session() as session:
         stmt = select(models.User).where(models.User.telegram_id == telegram_id)
         user: Optional[models.User] = await session.scalar(stmt)
         return user
 
 
 async def update_user(user_pk: int, **kwargs):
-    async with models.async_session() as session:
+    async with container.db_session() as session:
         user = await session.get(models.User, user_pk)
         for field, value in kwargs.items():
             setattr(user, field, value)
@@ -35,11 +37,60 @@ async def update_user(user_pk: int, **kwargs):
 
 
 async def update_user_values(telegram_id: int, values: list[str]):
-    async with models.async_session() as session:
+    async with container.db_session() as session:
         stmt = select(models.User).where(models.User.telegram_id == telegram_id)
         user: Optional[models.User] = await session.scalar(stmt)
         if user.values:
             user.values = [*user.values, *values]
         else:
             user.values = values
+        user.values_updated_at = func.clock_timestamp()
         await session.commit()
+
+
+async def update_thread_usage(thread_id: str, messages: int, context_tokens: Optional[int]):
+    """Считает сообщения треда и запоминает текущий размер контекста — prompt последнего рана"""
+    values = {"thread_message_count": models.User.thread_message_count + messages}
+    if context_tokens is not None:
+        values["thread_tokens"] = context_tokens
+    async with container.db_session() as session:
+        stmt = update(models.User).where(models.User.thread_id == thread_id).values(**values)
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def replace_user_thread(user_pk: int, old_thread_id: str, new_thread_id: str) -> bool:
+    """Меняет тред пользователя, только если его не успели поменять параллельно"""
+    async with container.db_session() as session:
+        stmt = (
+            update(models.User)
+            .where(models.User.id == user_pk, models.User.thread_id == old_thread_id)
+            .values(thread_id=new_thread_id, thread_message_count=0, thread_tokens=0)
+        )
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def stream_user_values(
+        updated_after: Optional[datetime] = None,
+        safety_lag: timedelta = timedelta(minutes=5),
+        batch_size: int = 1000
+) -> AsyncIterator[Sequence[Row]]:
+    """Отдает пользователей пачками через серверный курсор, не загружая всю таблицу в память.
+
+    Строки моложе `safety_lag` не отдаются: транзакция, которая еще не закоммичена, может получить
+    `values_updated_at` меньше выгруженного водяного знака и пропасть из инкрементальной выгрузки.
+    """
+    stmt = (
+        select(models.User.id, models.User.telegram_id, models.User.values, models.User.values_updated_at)
+        .where(models.User.values_updated_at <= func.clock_timestamp() - safety_lag)
+        .order_by(models.User.values_updated_at, models.User.id)
+        .execution_options(yield_per=batch_size)
+    )
+    if updated_after:
+        stmt = stmt.where(models.User.values_updated_at > updated_after)
+    async with container.db_engine.connect() as conn:
+        result = await conn.stream(stmt)
+        async for partition in result.partitions():
+            yield partition
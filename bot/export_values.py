@@ -0,0 +1,148 @@
+"""Выгрузка пользователей и их ценностей для офлайн-аналитики.
+
+Usage:
+    python bot/export_values.py --output export/values.jsonl.gz
+    python bot/export_values.py --output export/values.parquet --format parquet --watermark-file export/watermark.json
+"""
+import os
+import gzip
+import json
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Sequence
+
+from sqlalchemy import Row
+
+from container import container
+from database import requests
+
+
+class JsonlExportWriter:
+    def __init__(self, path: str):
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, rows: Sequence[Row]):
+        for row in rows:
+            self.file.write(json.dumps(_serialize_row(row), ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export requires `pyarrow` to be installed")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("id", pyarrow.int64()),
+            ("telegram_id", pyarrow.int64()),
+            ("values", pyarrow.list_(pyarrow.string())),
+            ("values_updated_at", pyarrow.timestamp("us", tz="UTC")),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows: Sequence[Row]):
+        columns = {name: [getattr(row, name) for row in rows] for name in self.schema.names}
+        self.writer.write_table(self.pyarrow.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {
+    "jsonl": JsonlExportWriter,
+    "parquet": ParquetExportWriter,
+}
+
+
+async def export_values(
+        output: str,
+        export_format: str,
+        updated_after: Optional[datetime],
+        safety_lag: timedelta,
+        batch_size: int
+) -> tuple[int, Optional[datetime]]:
+    writer = WRITERS[export_format](output)
+    exported, watermark = 0, updated_after
+    try:
+        async for rows in requests.stream_user_values(
+                updated_after=updated_after,
+                safety_lag=safety_lag,
+                batch_size=batch_size
+        ):
+            writer.write(rows)
+            exported += len(rows)
+            # rows are ordered by `values_updated_at`, the last one of a batch is the newest so far
+            watermark = rows[-1].values_updated_at
+    finally:
+        writer.close()
+    return exported, watermark
+
+
+def read_watermark(path: str) -> Optional[datetime]:
+    if not os.path.exists(path):
+        return
+    with open(path) as file:
+        return datetime.fromisoformat(json.load(file)["updated_at"])
+
+
+def write_watermark(path: str, watermark: datetime):
+    with open(path, "w") as file:
+        json.dump({"updated_at": watermark.isoformat()}, file)
+
+
+def _serialize_row(row: Row) -> dict:
+    return {
+        "id": row.id,
+        "telegram_id": row.telegram_id,
+        "values": row.values or [],
+        "values_updated_at": row.values_updated_at.isoformat(),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--format", dest="export_format", choices=WRITERS, default="jsonl")
+    parser.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        help="export users whose values changed after this ISO datetime"
+    )
+    parser.add_argument("--watermark-file", help="read --since from and save the new watermark to this file")
+    parser.add_argument(
+        "--safety-lag",
+        type=int,
+        default=300,
+        help="seconds, users whose values changed more recently are left for the next export to not miss late commits"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    updated_after = args.since
+    if updated_after is None and args.watermark_file:
+        updated_after = read_watermark(args.watermark_file)
+    try:
+        exported, watermark = await export_values(
+            output=args.output,
+            export_format=args.export_format,
+            updated_after=updated_after,
+            safety_lag=timedelta(seconds=args.safety_lag),
+            batch_size=args.batch_size
+        )
+    finally:
+        await container.close()
+    if args.watermark_file and watermark:
+        write_watermark(args.watermark_file, watermark)
+    logging.info(f"Exported {exported} users to {args.output}, watermark: {watermark}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
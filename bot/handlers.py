@@ -1,7 +1,8 @@
+import logging
+
 from aiogram import Dispatcher, Router, types
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
-from openai import AsyncOpenAI
 
 from ampli import (
     UserRegistrationEvent,
@@ -9,20 +10,21 @@ from ampli import (
     UserSendVoiceEvent,
     UserSendPhotoEvent,
 )
-from config import config
 from database import requests
 import utils
+from container import container
+from scheduler import SchedulerMiddleware
 from services import (
     AssistantService,
     VoiceToTextOpenAIService,
     TextToVoiceOpenAIService,
-    ImageRecognitionService
+    ImageRecognitionService,
+    ThreadRotationService
 )
 from states import UserInfo
 
 
 router = Router()
-client = AsyncOpenAI(api_key=config.openai_api_key)
 
 
 @router.message(Command("start"))
@@ -42,34 +44,68 @@ async def handle_text(message: types.Message):
 async def handle_voice(message: types.Message, state: FSMContext):
     await state.set_state(UserInfo.thread_id)
     await utils.send_event_to_amplitude(user_id=message.from_user.id, event=UserSendVoiceEvent())
-    thread = await utils.get_or_create_thread_for_user(tg_user_id=message.from_user.id)
+    try:
+        thread = await utils.get_or_create_thread_for_user(tg_user_id=message.from_user.id)
+    except Exception as e:
+        logging.error(f"Getting thread for user failed: {e}")
+        await message.reply("Something went wrong, try again later")
+        return
     await state.update_data(thread_id=thread.id)
     data = await state.get_data()
     print("Print just to show that thread_id was stored in the state |", data["thread_id"])
     await state.clear()
-    message_text = await VoiceToTextOpenAIService(client=client).voice_to_text(message=message)
-    assistant_service = await AssistantService(
-        client=client,
-        thread_id=thread.id,
-        tg_user_id=message.from_user.id
-    ).initialize()
+    try:
+        message_text = await VoiceToTextOpenAIService(client=container.openai_client).voice_to_text(message=message)
+    except Exception as e:
+        logging.error(f"Voice transcription failed: {e}")
+        await message.reply("Something went wrong, try again later")
+        return
+    try:
+        assistant_service = await AssistantService(
+            client=container.openai_client,
+            thread_id=thread.id,
+            tg_user_id=message.from_user.id
+        ).initialize()
+    except Exception as e:
+        logging.error(f"Assistant initialization failed: {e}")
+        await message.reply("Something went wrong, try again later")
+        return
     answer = await assistant_service.get_answer(message_text=message_text)
 
     if not answer:
         await message.reply("Something went wrong, try again later")
         return
 
-    ogg_voice = await TextToVoiceOpenAIService(client=client).text_to_voice(text=answer)
-    await message.answer_voice(ogg_voice)
+    try:
+        await TextToVoiceOpenAIService(client=container.openai_client).answer_voice(message=message, text=answer)
+    except Exception as e:
+        # TTS is unavailable, the answer is still worth sending as text
+        logging.error(f"Text to voice failed, falling back to text answer: {e}")
+        await message.answer(answer)
+    await _rotate_thread(tg_user_id=message.from_user.id)
 
 
 @router.message(lambda message: message.photo)
 async def handle_image(message: types.Message):
     await utils.send_event_to_amplitude(user_id=message.from_user.id, event=UserSendPhotoEvent())
-    service = ImageRecognitionService(client=client)
-    mood_result = await service.recognize_mood_by_photo(message=message)
+    service = ImageRecognitionService(client=container.openai_client)
+    try:
+        mood_result = await service.recognize_mood_by_photo(message=message)
+    except Exception as e:
+        logging.error(f"Mood recognition failed: {e}")
+        await message.reply("Something went wrong, try again later")
+        return
     await message.answer(mood_result)
 
 
+async def _rotate_thread(tg_user_id: int):
+    # the answer is already sent, a failed rotation is retried after the next voice message
+    try:
+        await ThreadRotationService(client=container.openai_client).rotate_if_needed(tg_user_id=tg_user_id)
+    except Exception as e:
+        logging.error(f"Thread rotation failed: {e}")
+
+
 def register_handlers(dp: Dispatcher):
+    dp.message.outer_middleware(SchedulerMiddleware(scheduler=container.scheduler))
     dp.include_router(router)
@@ -1,26 +1,54 @@
+import time
+
+started_at = time.perf_counter()
+
 import os
 import asyncio
 import logging
 
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.redis import RedisStorage, Redis
-
 from config import config
+from container import container
 from handlers import register_handlers
+from services import AssistantRunRecoveryService
 
 logging.basicConfig(level=logging.INFO)
+imported_at = time.perf_counter()
+background_tasks: set[asyncio.Task] = set()
+
+
+async def on_startup():
+    logging.info(
+        f"Modules imported in {imported_at - started_at:.3f}s, "
+        f"ready to accept updates in {time.perf_counter() - started_at:.3f}s"
+    )
+
+
+async def cancel_stale_assistant_runs():
+    # runs orphaned by a previous process are cleaned up without delaying the startup
+    recovery_task = asyncio.create_task(AssistantRunRecoveryService(client=container.openai_client).cancel_stale_runs())
+    background_tasks.add(recovery_task)
+    recovery_task.add_done_callback(_on_background_task_done)
+
 
-redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
-bot = Bot(token=config.telegram_api_token)
-dp = Dispatcher(bot=bot, storage=RedisStorage(redis=redis))
-os.makedirs(config.storage_dir, exist_ok=True)  # creating local storage for mp3 and jpg
+def _on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"Background task failed: {task.exception()}")
 
 
 async def main():
+    os.makedirs(config.storage_dir, exist_ok=True)  # creating local storage for mp3 and jpg
+    dp = container.dispatcher
     register_handlers(dp)
-    await dp.start_polling(bot)
+    dp.startup.register(container.scheduler.start)
+    dp.startup.register(cancel_stale_assistant_runs)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(container.scheduler.stop)
+    try:
+        await dp.start_polling(container.bot)
+    finally:
+        await container.close()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
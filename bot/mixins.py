@@ -1,21 +1,27 @@
 import os
-from typing import Literal, Optional
+from typing import Any, Awaitable, Callable, Literal, Optional
 
 from aiogram import types
 from openai import AsyncOpenAI
 
+import resilience
 from config import config
+from rate_limit import Priority
 
 
 class OpenAIClientMixin:
     """Миксин, используется везде, где нужен клиент опенаи"""
 
     model = "gpt-4o"
+    priority = Priority.USER
 
     def __init__(self, client: AsyncOpenAI, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.client = client
 
+    async def _request(self, endpoint: str, method: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        return await resilience.call_openai(endpoint, method, *args, priority=self.priority, **kwargs)
+
 
 class SaveFileLocallyMixin:
     file_extension_mapping = {
@@ -0,0 +1,172 @@
+import time
+import asyncio
+import logging
+from enum import IntEnum
+from typing import Optional
+
+import httpx
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from container import container
+
+
+class Priority(IntEnum):
+    USER = 0
+    BACKGROUND = 1
+
+
+# resilience endpoint -> rate limit bucket, endpoints sharing a model share its org limits
+ENDPOINT_BUCKETS = {
+    "whisper": "audio_transcriptions",
+    "tts": "audio_speech",
+    "chat": "chat_completions",
+    "vision": "chat_completions",
+    "assistants": "assistants",
+    "runs": "assistants",
+    "vector_stores": "assistants",
+}
+
+# requests per minute used until OpenAI reports the real limits in response headers
+DEFAULT_LIMITS = {
+    "audio_transcriptions": 50,
+    "audio_speech": 50,
+    "chat_completions": 500,
+    "assistants": 300,
+}
+
+# share of the bucket that background calls are not allowed to spend
+BACKGROUND_RESERVE = 0.2
+MAX_WAIT_SECONDS = 30
+
+ACQUIRE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'capacity', 'rate')
+local capacity = tonumber(bucket[3]) or tonumber(ARGV[1])
+local rate = tonumber(bucket[4]) or tonumber(ARGV[2])
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) / 1000 * rate)
+local floor = capacity * tonumber(ARGV[3])
+local wait_ms = 0
+if tokens - 1 >= floor then
+    tokens = tokens - 1
+else
+    wait_ms = math.ceil((floor + 1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'capacity', capacity, 'rate', rate)
+redis.call('PEXPIRE', KEYS[1], 300000)
+return wait_ms
+"""
+
+ADAPT_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local limit = tonumber(ARGV[1])
+local remaining = tonumber(ARGV[2])
+local reset_seconds = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'rate')
+local tokens = tonumber(bucket[1]) or remaining
+local rate = tonumber(bucket[2]) or limit / 60
+if reset_seconds > 0 and remaining < limit then
+    rate = (limit - remaining) / reset_seconds
+end
+redis.call('HSET', KEYS[1], 'tokens', math.min(tokens, remaining), 'ts', now, 'capacity', limit, 'rate', rate)
+redis.call('PEXPIRE', KEYS[1], 300000)
+return 1
+"""
+
+
+class OpenAIRateLimiter:
+    """Общий для всех инстансов бота token bucket на Redis, по одному на группу эндпоинтов OpenAI"""
+
+    key_prefix = "openai:ratelimit"
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._acquire_script = redis.register_script(ACQUIRE_SCRIPT)
+        self._adapt_script = redis.register_script(ADAPT_SCRIPT)
+
+    async def acquire(self, endpoint: str, priority: Priority = Priority.USER):
+        bucket = ENDPOINT_BUCKETS[endpoint]
+        limit = DEFAULT_LIMITS[bucket]
+        reserve = BACKGROUND_RESERVE if priority == Priority.BACKGROUND else 0
+        deadline = time.monotonic() + MAX_WAIT_SECONDS
+        while True:
+            try:
+                wait_ms = await self._acquire_script(keys=[self._key(bucket)], args=[limit, limit / 60, reserve])
+            except RedisError as e:
+                # limiter is an optimization, OpenAI stays reachable without it
+                logging.warning(f"Rate limiter is unavailable, skipping: {e}")
+                return
+            if not wait_ms:
+                return
+            wait = int(wait_ms) / 1000
+            if time.monotonic() + wait > deadline:
+                logging.warning(f"Rate limit budget for `{bucket}` is exhausted, sending request anyway")
+                return
+            await asyncio.sleep(wait)
+
+    async def adapt(self, bucket: str, limit: int, remaining: int, reset_seconds: float):
+        try:
+            await self._adapt_script(keys=[self._key(bucket)], args=[limit, remaining, reset_seconds])
+        except RedisError as e:
+            logging.warning(f"Rate limiter is unavailable, skipping: {e}")
+
+    def _key(self, bucket: str) -> str:
+        return f"{self.key_prefix}:{bucket}"
+
+
+async def adapt_from_response(response: httpx.Response):
+    """httpx hook: подстраивает бюджет под лимиты, которые OpenAI вернул в заголовках"""
+    headers = response.headers
+    limit = headers.get("x-ratelimit-limit-requests")
+    remaining = headers.get("x-ratelimit-remaining-requests")
+    if limit is None or remaining is None:
+        return
+    bucket = _get_bucket_by_path(response.request.url.path)
+    if not bucket:
+        return
+    try:
+        limit, remaining = int(limit), int(remaining)
+    except ValueError:
+        return
+    reset_seconds = _parse_duration(headers.get("x-ratelimit-reset-requests", ""))
+    await container.rate_limiter.adapt(bucket=bucket, limit=limit, remaining=remaining, reset_seconds=reset_seconds)
+
+
+def _get_bucket_by_path(path: str) -> Optional[str]:
+    path = path.removeprefix("/v1")
+    if path.startswith("/audio/transcriptions"):
+        return "audio_transcriptions"
+    if path.startswith("/audio/speech"):
+        return "audio_speech"
+    if path.startswith("/chat/completions"):
+        return "chat_completions"
+    if path.startswith(("/threads", "/assistants", "/vector_stores", "/files")):
+        return "assistants"
+
+
+def _parse_duration(value: str) -> float:
+    """Разбирает длительности OpenAI вида `1s`, `6m0s`, `20ms`"""
+    seconds = 0.0
+    number = ""
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isdigit() or char == ".":
+            number += char
+        elif number:
+            if value.startswith("ms", i):
+                seconds += float(number) / 1000
+                i += 1
+            elif char == "h":
+                seconds += float(number) * 3600
+            elif char == "m":
+                seconds += float(number) * 60
+            elif char == "s":
+                seconds += float(number)
+            number = ""
+        i += 1
+    return seconds
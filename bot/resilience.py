@@ -0,0 +1,206 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+from dataclasses import dataclass
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from config import config
+from container import container
+from rate_limit import Priority, adapt_from_response
+from ampli import executor, CircuitBreakerStateEvent
+
+
+METRICS_USER_ID = "bot-system"
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Эндпоинт временно отключен предохранителем, запрос не отправлялся"""
+
+    def __init__(self, endpoint: str):
+        super().__init__(f"Circuit for OpenAI endpoint `{endpoint}` is open")
+        self.endpoint = endpoint
+
+
+@dataclass(frozen=True)
+class EndpointPolicy:
+    timeout: float
+    max_retries: int
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    backoff_base: float = 0.5
+    backoff_cap: float = 8.0
+
+
+ENDPOINT_POLICIES = {
+    "whisper": EndpointPolicy(timeout=30, max_retries=2),
+    "tts": EndpointPolicy(timeout=30, max_retries=2),
+    "chat": EndpointPolicy(timeout=30, max_retries=2),
+    "vision": EndpointPolicy(timeout=45, max_retries=1),
+    "assistants": EndpointPolicy(timeout=15, max_retries=2),
+    "runs": EndpointPolicy(timeout=120, max_retries=1),
+    "vector_stores": EndpointPolicy(timeout=180, max_retries=0),
+}
+
+
+class CircuitBreaker:
+    """Предохранитель для одного эндпоинта OpenAI"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, endpoint: str, failure_threshold: int, reset_timeout: float):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._trial_in_flight = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def release_trial(self):
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        logging.warning(f"OpenAI circuit `{self.endpoint}`: {self.state} -> {state}")
+        self.state = state
+        event = CircuitBreakerStateEvent(endpoint=self.endpoint, state=state)
+        executor.submit(container.amplitude.track, METRICS_USER_ID, event)
+
+
+breakers: dict[str, CircuitBreaker] = {
+    endpoint: CircuitBreaker(
+        endpoint=endpoint,
+        failure_threshold=policy.failure_threshold,
+        reset_timeout=policy.reset_timeout
+    )
+    for endpoint, policy in ENDPOINT_POLICIES.items()
+}
+
+
+def create_openai_client() -> AsyncOpenAI:
+    # retries are handled by `call_openai`, the client must not retry on its own
+    return AsyncOpenAI(
+        api_key=config.openai_api_key,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(event_hooks={"response": [adapt_from_response]})
+    )
+
+
+async def call_openai(
+        endpoint: str,
+        method: Callable[..., Awaitable[Any]],
+        *args,
+        priority: Priority = Priority.USER,
+        idempotent: bool = True,
+        **kwargs
+) -> Any:
+    policy = ENDPOINT_POLICIES[endpoint]
+    breaker = breakers[endpoint]
+    attempt = 0
+    while True:
+        if breaker.is_open:
+            raise CircuitOpenError(endpoint)
+        await container.rate_limiter.acquire(endpoint=endpoint, priority=priority)
+        if not breaker.allow_request():
+            raise CircuitOpenError(endpoint)
+        try:
+            result = await asyncio.wait_for(method(*args, **kwargs), timeout=policy.timeout)
+        except RETRYABLE_ERRORS as e:
+            gives_up = attempt >= policy.max_retries or not _is_safe_to_retry(e, idempotent)
+            # a 429 means the quota is spent, not that the endpoint is down,
+            # and a failed call counts once, however many attempts it took
+            if gives_up and not isinstance(e, openai.RateLimitError):
+                breaker.record_failure()
+            else:
+                breaker.release_trial()
+            if gives_up or breaker.is_open:
+                raise
+            delay = _get_retry_delay(policy=policy, attempt=attempt, error=e)
+            logging.warning(f"OpenAI `{endpoint}` failed ({type(e).__name__}), retry in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+        except asyncio.CancelledError:
+            breaker.release_trial()
+            raise
+        except Exception:
+            # request reached the API and was rejected, the endpoint itself is alive
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def _is_safe_to_retry(error: Exception, idempotent: bool) -> bool:
+    if idempotent:
+        return True
+    # the request may have been applied already, only errors raised before it reached the API are retried
+    return (
+        isinstance(error, openai.RateLimitError)
+        or isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout))
+    )
+
+
+def _get_retry_delay(policy: EndpointPolicy, attempt: int, error: Exception) -> float:
+    delay = random.uniform(0, min(policy.backoff_cap, policy.backoff_base * 2 ** attempt))
+    retry_after = _get_retry_after(error)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _get_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return
+    headers = response.headers
+    try:
+        if retry_after_ms := headers.get("retry-after-ms"):
+            return float(retry_after_ms) / 1000
+        if retry_after := headers.get("retry-after"):
+            return float(retry_after)
+    except ValueError:
+        return
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from container import container
+
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+REFRESH_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RunLeaseTimeoutError(Exception):
+    """Тред занят другим обработчиком дольше, чем можно ждать"""
+
+    def __init__(self, thread_id: str):
+        super().__init__(f"Thread {thread_id} is leased by another handler")
+        self.thread_id = thread_id
+
+
+class AssistantRunStateStore:
+    """Чекпоинты запусков ассистента, чтобы прерванный запуск можно было продолжить или отменить"""
+
+    PHASE_MESSAGE_SENT = "message_sent"
+    PHASE_RUN_STARTED = "run_started"
+    PHASE_VALUES_SAVED = "values_saved"
+
+    key_prefix = "assistant_run"
+    lease_key_prefix = "assistant_run_lease"
+    ttl_seconds = 60 * 60 * 24
+    # the lease is refreshed while its owner is alive, so it expires soon after the owner dies
+    lease_seconds = 30
+    lease_wait_seconds = 180
+
+    def __init__(self, redis: Optional[Redis] = None):
+        self.redis = redis or container.redis
+        self._refresh_lease_script = self.redis.register_script(REFRESH_LEASE_SCRIPT)
+        self._release_lease_script = self.redis.register_script(RELEASE_LEASE_SCRIPT)
+
+    @asynccontextmanager
+    async def lease(self, thread_id: str, wait_seconds: Optional[float] = None):
+        """Дает работать с тредом одному обработчику, чекпоинт без живой аренды брошен упавшим процессом"""
+        token = f"{INSTANCE_ID}:{uuid.uuid4().hex}"
+        wait_seconds = self.lease_wait_seconds if wait_seconds is None else wait_seconds
+        acquired = await self._acquire_lease(thread_id=thread_id, token=token, wait_seconds=wait_seconds)
+        heartbeat = asyncio.create_task(self._keep_lease(thread_id=thread_id, token=token)) if acquired else None
+        try:
+            yield
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+                await self._release_lease(thread_id=thread_id, token=token)
+
+    async def get(self, thread_id: str) -> Optional[dict]:
+        try:
+            state = await self.redis.get(self._key(thread_id))
+        except RedisError as e:
+            logging.warning(f"Assistant run state store is unavailable: {e}")
+            return
+        return json.loads(state) if state else None
+
+    async def save(self, thread_id: str, phase: str, message: str, run_id: Optional[str] = None):
+        state = {
+            "phase": phase,
+            "message": message,
+            "run_id": run_id,
+            "owner": INSTANCE_ID,
+            "updated_at": time.time(),
+        }
+        try:
+            await self.redis.set(self._key(thread_id), json.dumps(state), ex=self.ttl_seconds)
+        except RedisError as e:
+            logging.warning(f"Assistant run state store is unavailable: {e}")
+
+    async def delete(self, thread_id: str):
+        try:
+            await self.redis.delete(self._key(thread_id))
+        except RedisError as e:
+            logging.warning(f"Assistant run state store is unavailable: {e}")
+
+    async def iter_thread_ids(self) -> AsyncIterator[str]:
+        async for key in self.redis.scan_iter(match=f"{self.key_prefix}:*"):
+            yield key.decode().removeprefix(f"{self.key_prefix}:")
+
+    async def _acquire_lease(self, thread_id: str, token: str, wait_seconds: float) -> bool:
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            try:
+                acquired = await self.redis.set(
+                    self._lease_key(thread_id),
+                    token,
+                    nx=True,
+                    px=self.lease_seconds * 1000
+                )
+            except RedisError as e:
+                logging.warning(f"Assistant run lease is unavailable, continuing without it: {e}")
+                return False
+            if acquired:
+                return True
+            if time.monotonic() >= deadline:
+                raise RunLeaseTimeoutError(thread_id)
+            await asyncio.sleep(0.5)
+
+    async def _keep_lease(self, thread_id: str, token: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                refreshed = await self._refresh_lease_script(
+                    keys=[self._lease_key(thread_id)],
+                    args=[token, self.lease_seconds * 1000]
+                )
+            except RedisError as e:
+                logging.warning(f"Failed to refresh assistant run lease for thread {thread_id}: {e}")
+                continue
+            if not refreshed:
+                logging.warning(f"Assistant run lease for thread {thread_id} was lost")
+                return
+
+    async def _release_lease(self, thread_id: str, token: str):
+        try:
+            await self._release_lease_script(keys=[self._lease_key(thread_id)], args=[token])
+        except RedisError as e:
+            logging.warning(f"Failed to release assistant run lease for thread {thread_id}: {e}")
+
+    def _key(self, thread_id: str) -> str:
+        return f"{self.key_prefix}:{thread_id}"
+
+    def _lease_key(self, thread_id: str) -> str:
+        return f"{self.lease_key_prefix}:{thread_id}"
@@ -0,0 +1,244 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, types
+
+
+@dataclass(frozen=True)
+class LaneConfig:
+    workers: int
+    max_queue: int
+    # jobs of one user that may run at the same time, None for no limit
+    max_user_in_flight: Optional[int] = None
+
+
+# voice answers take five and more sequential OpenAI calls, text answers take none
+LANES = {
+    "text": LaneConfig(workers=32, max_queue=1000),
+    "photo": LaneConfig(workers=8, max_queue=200),
+    # voice messages of one user share the assistant thread and are answered one by one anyway
+    "voice": LaneConfig(workers=4, max_queue=100, max_user_in_flight=1),
+}
+
+STATS_INTERVAL_SECONDS = 60
+
+
+class SchedulerQueueFullError(Exception):
+    """Очередь полосы переполнена, задача не принята"""
+
+    def __init__(self, lane: str):
+        super().__init__(f"Scheduler lane `{lane}` is full")
+        self.lane = lane
+
+
+@dataclass
+class _Job:
+    user_id: int
+    func: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class Lane:
+    """Ограниченная очередь с пулом воркеров, пользователи обслуживаются по кругу"""
+
+    def __init__(self, name: str, workers: int, max_queue: int, max_user_in_flight: Optional[int] = None):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_user_in_flight = max_user_in_flight
+        self._user_jobs: dict[int, deque[_Job]] = {}
+        # users with queued jobs that can be started now, users at their in-flight limit are left out
+        self._users_order: deque[int] = deque()
+        self._user_in_flight: dict[int, int] = {}
+        self._stopping = False
+        self._size = 0
+        self._has_jobs = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._waited_total = 0.0
+        self._waited_max = 0.0
+        self._processed = 0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_id: int, func: Callable[[], Awaitable[Any]]) -> Any:
+        if self._size >= self.max_queue:
+            raise SchedulerQueueFullError(self.name)
+        job = _Job(
+            user_id=user_id,
+            func=func,
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=time.monotonic()
+        )
+        if user_id not in self._user_jobs:
+            self._user_jobs[user_id] = deque()
+            if not self._is_user_at_limit(user_id):
+                self._users_order.append(user_id)
+                self._has_jobs.set()
+        self._user_jobs[user_id].append(job)
+        self._size += 1
+        return await job.future
+
+    def pop_stats(self) -> dict:
+        stats = {
+            "lane": self.name,
+            "queue_depth": self._size,
+            "processed": self._processed,
+            "avg_wait": self._waited_total / self._processed if self._processed else 0.0,
+            "max_wait": self._waited_max,
+        }
+        self._waited_total = self._waited_max = 0.0
+        self._processed = 0
+        return stats
+
+    async def _work(self):
+        while True:
+            await self._has_jobs.wait()
+            job = self._next_job()
+            if job is None:
+                continue
+            waited = time.monotonic() - job.enqueued_at
+            self._waited_total += waited
+            self._waited_max = max(self._waited_max, waited)
+            self._processed += 1
+            try:
+                await self._run(job)
+            finally:
+                self._finish_job(job.user_id)
+
+    async def _run(self, job: _Job):
+        if job.future.cancelled():
+            return
+        try:
+            result = await job.func()
+        except asyncio.CancelledError:
+            # a job cancelled from inside must not take the worker with it, only stopping the lane does
+            if self._stopping:
+                raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            # whatever ended the job, its caller must not wait forever
+            if not job.future.done():
+                job.future.cancel()
+
+    def _next_job(self) -> Optional[_Job]:
+        if not self._users_order:
+            self._has_jobs.clear()
+            return
+        user_id = self._users_order.popleft()
+        jobs = self._user_jobs[user_id]
+        job = jobs.popleft()
+        self._user_in_flight[user_id] = self._user_in_flight.get(user_id, 0) + 1
+        if not jobs:
+            del self._user_jobs[user_id]
+        elif not self._is_user_at_limit(user_id):
+            # the user goes to the end of the line, so one user's burst can't hold the lane
+            self._users_order.append(user_id)
+        self._size -= 1
+        if not self._users_order:
+            self._has_jobs.clear()
+        return job
+
+    def _finish_job(self, user_id: int):
+        was_at_limit = self._is_user_at_limit(user_id)
+        self._user_in_flight[user_id] -= 1
+        if not self._user_in_flight[user_id]:
+            del self._user_in_flight[user_id]
+        if was_at_limit and user_id in self._user_jobs:
+            # the user waited for their running job, their next one is queued again
+            self._users_order.append(user_id)
+            self._has_jobs.set()
+
+    def _is_user_at_limit(self, user_id: int) -> bool:
+        if self.max_user_in_flight is None:
+            return False
+        return self._user_in_flight.get(user_id, 0) >= self.max_user_in_flight
+
+
+class WorkScheduler:
+    """Распределяет обработку апдейтов по полосам, чтобы тяжелые голосовые не вытесняли дешевые ответы"""
+
+    def __init__(self, lanes: dict[str, LaneConfig] = LANES):
+        self.lanes = {
+            name: Lane(
+                name=name,
+                workers=lane.workers,
+                max_queue=lane.max_queue,
+                max_user_in_flight=lane.max_user_in_flight
+            )
+            for name, lane in lanes.items()
+        }
+        self._stats_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        for lane in self.lanes.values():
+            lane.start()
+        self._stats_task = asyncio.create_task(self._log_stats())
+
+    async def stop(self):
+        if self._stats_task:
+            self._stats_task.cancel()
+        for lane in self.lanes.values():
+            await lane.stop()
+
+    async def submit(self, lane: str, user_id: int, func: Callable[[], Awaitable[Any]]) -> Any:
+        return await self.lanes[lane].submit(user_id=user_id, func=func)
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL_SECONDS)
+            for lane in self.lanes.values():
+                stats = lane.pop_stats()
+                logging.info(
+                    f"Scheduler lane `{stats['lane']}`: queue depth {stats['queue_depth']}, "
+                    f"processed {stats['processed']}, avg wait {stats['avg_wait']:.3f}s, "
+                    f"max wait {stats['max_wait']:.3f}s"
+                )
+
+
+class SchedulerMiddleware(BaseMiddleware):
+    """Пропускает обработку сообщений через планировщик"""
+
+    def __init__(self, scheduler: WorkScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(
+            self,
+            handler: Callable[[types.Message, Dict[str, Any]], Awaitable[Any]],
+            event: types.Message,
+            data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await self.scheduler.submit(
+                lane=self._get_lane(event),
+                user_id=event.from_user.id if event.from_user else event.chat.id,
+                func=lambda: handler(event, data)
+            )
+        except SchedulerQueueFullError as e:
+            logging.warning(str(e))
+            await event.reply("I'm overloaded right now, try again in a minute")
+
+    @staticmethod
+    def _get_lane(message: types.Message) -> str:
+        if message.voice:
+            return "voice"
+        if message.photo:
+            return "photo"
+        return "text"
@@ -2,19 +2,26 @@ import os
 import io
 import re
 import json
+import time
 import uuid
 import logging
 import subprocess
 from typing import Optional
+from concurrent.futures.process import BrokenProcessPool
 
 from aiogram import types as aiogram_types
-from openai import AsyncOpenAI
+from aiogram.exceptions import TelegramBadRequest
 from openai.types.beta import Assistant, VectorStore
 from openai.types.beta.threads import RequiredActionFunctionToolCall, Run
 
 import utils
 import mixins
+import transcription
 from config import config
+from container import container
+from cache import VoiceAssetCache, TranscriptionCache
+from run_state import AssistantRunStateStore, RunLeaseTimeoutError
+from rate_limit import Priority
 from database import requests
 from ampli import (
     ValueValidationEvent,
@@ -22,9 +29,6 @@ from ampli import (
 )
 
 
-openai_client = AsyncOpenAI(api_key=config.openai_api_key)
-
-
 class AssistantService(mixins.OpenAIClientMixin):
     """Сервис для работы с ассистентом"""
 
@@ -50,9 +54,16 @@ class AssistantService(mixins.OpenAIClientMixin):
     async def initialize(self):
         if not self.assistant:
             if config.assistant_id:
-                self.assistant = await self.client.beta.assistants.retrieve(assistant_id=config.assistant_id)
+                self.assistant = await self._request(
+                    "assistants",
+                    self.client.beta.assistants.retrieve,
+                    assistant_id=config.assistant_id
+                )
             else:
-                self.assistant = await self.client.beta.assistants.create(
+                self.assistant = await self._request(
+                    "assistants",
+                    self.client.beta.assistants.create,
+                    idempotent=False,
                     name=self.assistant_name,
                     instructions=self.assistant_prompt,
                     model=self.model,
@@ -94,12 +105,33 @@ class AssistantService(mixins.OpenAIClientMixin):
                 thread_id=self.thread_id,
                 assistant_id=self.assistant.id
             )
-            await answer_retriever.ask_question(message=message_text)
-            assistant_answer = await answer_retriever.retrieve_answer(message=message_text, tg_user_id=self.tg_user_id)
-            if assistant_answer:
-                return assistant_answer
+            # concurrent voice messages of one user share the thread, they are answered one by one
+            async with answer_retriever.run_state.lease(self.thread_id):
+                await answer_retriever.resume_pending_run(tg_user_id=self.tg_user_id)
+                await answer_retriever.ask_question(message=message_text)
+                assistant_answer = await answer_retriever.retrieve_answer(
+                    message=message_text,
+                    tg_user_id=self.tg_user_id
+                )
         except Exception as e:
             logging.error(f"Unexpected error when trying to get OpenAI response: {e}")
+            return
+        await self._track_thread_usage(run=answer_retriever.run, answered=bool(assistant_answer))
+        if assistant_answer:
+            return assistant_answer
+
+    async def _track_thread_usage(self, run: Run, answered: bool):
+        # the answer is already paid for, failing to count it must not cost the user their reply
+        try:
+            # the run's prompt is the whole thread, so it is the thread's current context size
+            context_tokens = run.usage.prompt_tokens if run.usage else None
+            await requests.update_thread_usage(
+                thread_id=self.thread_id,
+                messages=1 + answered,
+                context_tokens=context_tokens
+            )
+        except Exception as e:
+            logging.error(f"Failed to track usage of thread {self.thread_id}: {e}")
 
 
 class OpenAIAnswerRetrieveService(mixins.OpenAIClientMixin):
@@ -107,54 +139,153 @@ class OpenAIAnswerRetrieveService(mixins.OpenAIClientMixin):
 
     ASSISTANCE_COMPLETED_STATUS = "completed"
     ASSISTANCE_REQUIRES_ACTION_STATUS = "requires_action"
+    ASSISTANCE_ACTIVE_STATUSES = ("queued", "in_progress", "cancelling")
+    ASSISTANCE_CANCELLABLE_STATUSES = ("queued", "in_progress", "requires_action")
+
+    # runs older than this are not worth finishing, the user has stopped waiting for them
+    STALE_RUN_SECONDS = 5 * 60
 
     assistant_id: str
     thread_id: str
     run: Run
 
-    def __init__(self, assistant_id: str, thread_id: str, *args, **kwargs):
+    def __init__(
+            self,
+            assistant_id: str,
+            thread_id: str,
+            *args,
+            run_state: Optional[AssistantRunStateStore] = None,
+            **kwargs
+    ):
         super().__init__(*args, **kwargs)
         self.assistant_id = assistant_id
         self.thread_id = thread_id
+        self.run_state = run_state or AssistantRunStateStore()
+
+    async def resume_pending_run(self, tg_user_id: int):
+        """Доводит до конца или отменяет запуск, оборванный упавшим процессом. Вызывается под арендой треда"""
+        state = await self.run_state.get(self.thread_id)
+        if not state:
+            return
+        # a run whose creation timed out is not checkpointed, but may still have been started
+        run_id = state["run_id"] or await self._find_unfinished_run_id()
+        if run_id:
+            self.run = await self._request(
+                "assistants",
+                self.client.beta.threads.runs.retrieve,
+                run_id,
+                thread_id=self.thread_id
+            )
+            is_unfinished = (
+                self.run.status in self.ASSISTANCE_ACTIVE_STATUSES
+                or self.run.status == self.ASSISTANCE_REQUIRES_ACTION_STATUS
+            )
+            if is_unfinished and time.time() - state["updated_at"] > self.STALE_RUN_SECONDS:
+                await self._cancel_run()
+            elif is_unfinished:
+                logging.info(f"Resuming run {self.run.id} in thread {self.thread_id} from phase {state['phase']}")
+                await self._poll_run()
+                if self.run.status == self.ASSISTANCE_REQUIRES_ACTION_STATUS:
+                    await self.retrieve_answer(
+                        tg_user_id=tg_user_id,
+                        message=state["message"],
+                        values_saved=state["phase"] == AssistantRunStateStore.PHASE_VALUES_SAVED
+                    )
+        # without a run the orphaned message stays in the thread and is answered by the next run
+        await self.run_state.delete(self.thread_id)
 
     async def ask_question(self, message: str):
-        await self.client.beta.threads.messages.create(
+        await self._request(
+            "assistants",
+            self.client.beta.threads.messages.create,
+            idempotent=False,
             thread_id=self.thread_id,
             role="user",
             content=message
         )
-        self.run = await self.client.beta.threads.runs.create_and_poll(
+        await self.run_state.save(self.thread_id, phase=AssistantRunStateStore.PHASE_MESSAGE_SENT, message=message)
+        self.run = await self._request(
+            "assistants",
+            self.client.beta.threads.runs.create,
+            idempotent=False,
             model=self.model,
             thread_id=self.thread_id,
-            assistant_id=self.assistant_id,
-            poll_interval_ms=1000
+            assistant_id=self.assistant_id
+        )
+        await self.run_state.save(
+            self.thread_id,
+            phase=AssistantRunStateStore.PHASE_RUN_STARTED,
+            message=message,
+            run_id=self.run.id
         )
+        await self._poll_run()
 
-    async def retrieve_answer(self, tg_user_id: int, message: str) -> Optional[str]:
+    async def retrieve_answer(self, tg_user_id: int, message: str, values_saved: bool = False) -> Optional[str]:
         answer = None
         if self.run.status == self.ASSISTANCE_COMPLETED_STATUS:
             answer = await self._extract_answer()
         elif self.run.status == self.ASSISTANCE_REQUIRES_ACTION_STATUS:
             tool_calls = self.run.required_action.submit_tool_outputs.tool_calls
             tool_outputs = list(map(self._get_output_from_tool_call, tool_calls))
-            await utils.validate_and_save_user_values(context=message, tool_outputs=tool_outputs, tg_user_id=tg_user_id)
+            if not values_saved:
+                await UserValueOpenAIValidator(client=self.client).validate_and_save(
+                    context=message,
+                    tool_outputs=tool_outputs,
+                    tg_user_id=tg_user_id
+                )
+                await self.run_state.save(
+                    self.thread_id,
+                    phase=AssistantRunStateStore.PHASE_VALUES_SAVED,
+                    message=message,
+                    run_id=self.run.id
+                )
 
-            self.run = await self.client.beta.threads.runs.submit_tool_outputs_and_poll(
+            self.run = await self._request(
+                "runs",
+                self.client.beta.threads.runs.submit_tool_outputs_and_poll,
+                idempotent=False,
                 thread_id=self.thread_id,
                 run_id=self.run.id,
                 tool_outputs=tool_outputs
             )
             if self.run.status == self.ASSISTANCE_COMPLETED_STATUS:
                 answer = await self._extract_answer()
+        await self.run_state.delete(self.thread_id)
         return answer
 
+    async def _find_unfinished_run_id(self) -> Optional[str]:
+        runs = await self._request("assistants", self.client.beta.threads.runs.list, thread_id=self.thread_id, limit=1)
+        if runs.data and runs.data[0].status in self.ASSISTANCE_CANCELLABLE_STATUSES:
+            return runs.data[0].id
+
+    async def _poll_run(self):
+        self.run = await self._request(
+            "runs",
+            self.client.beta.threads.runs.poll,
+            self.run.id,
+            thread_id=self.thread_id,
+            poll_interval_ms=1000
+        )
+
+    async def _cancel_run(self):
+        if self.run.status in self.ASSISTANCE_CANCELLABLE_STATUSES:
+            logging.info(f"Cancelling stale run {self.run.id} in thread {self.thread_id}")
+            self.run = await self._request(
+                "assistants",
+                self.client.beta.threads.runs.cancel,
+                self.run.id,
+                thread_id=self.thread_id
+            )
+        # a `cancelling` run still blocks the thread, the next run can be created only after it stops
+        await self._poll_run()
+
     async def _extract_answer(self) -> str:
-        messages = await self.client.beta.threads.messages.list(thread_id=self.thread_id)
+        messages = await self._request("assistants", self.client.beta.threads.messages.list, thread_id=self.thread_id)
         text = messages.data[0].content[0].text
         new_message = text.value
         if text.annotations:
             file_id = text.annotations[0].file_citation.file_id
-            file = await openai_client.files.retrieve(file_id)
+            file = await self._request("assistants", self.client.files.retrieve, file_id)
             new_message = self._remove_sources(new_message)
             new_message += f" Answer were taken from {file.filename}"
         return new_message
@@ -172,37 +303,221 @@ class OpenAIAnswerRetrieveService(mixins.OpenAIClientMixin):
         }
 
 
+class AssistantRunRecoveryService(mixins.OpenAIClientMixin):
+    """Сервис отменяет запуски ассистента, брошенные упавшим процессом"""
+
+    async def cancel_stale_runs(self):
+        run_state = AssistantRunStateStore()
+        async for thread_id in run_state.iter_thread_ids():
+            try:
+                # a thread leased by a live handler is not abandoned, however old its checkpoint is
+                async with run_state.lease(thread_id, wait_seconds=0):
+                    await self._cancel_stale_run(run_state=run_state, thread_id=thread_id)
+            except RunLeaseTimeoutError:
+                continue
+            except Exception as e:
+                logging.error(f"Failed to cancel stale run in thread {thread_id}: {e}")
+
+    async def _cancel_stale_run(self, run_state: AssistantRunStateStore, thread_id: str):
+        state = await run_state.get(thread_id)
+        if not state or time.time() - state["updated_at"] <= OpenAIAnswerRetrieveService.STALE_RUN_SECONDS:
+            return
+        if state["run_id"]:
+            await self._cancel_run(thread_id=thread_id, run_id=state["run_id"])
+        await run_state.delete(thread_id)
+
+    async def _cancel_run(self, thread_id: str, run_id: str):
+        run = await self._request("assistants", self.client.beta.threads.runs.retrieve, run_id, thread_id=thread_id)
+        if run.status in OpenAIAnswerRetrieveService.ASSISTANCE_CANCELLABLE_STATUSES:
+            logging.info(f"Cancelling stale run {run_id} in thread {thread_id}")
+            await self._request("assistants", self.client.beta.threads.runs.cancel, run_id, thread_id=thread_id)
+            await self._request(
+                "runs",
+                self.client.beta.threads.runs.poll,
+                run_id,
+                thread_id=thread_id,
+                poll_interval_ms=1000
+            )
+
+
+class ThreadRotationService(mixins.OpenAIClientMixin):
+    """Сервис заменяет разросшийся тред пользователя новым, начинающимся с краткого пересказа старого"""
+
+    MAX_THREAD_MESSAGES = 40
+    MAX_THREAD_TOKENS = 100_000
+    SUMMARY_MESSAGES_LIMIT = 100
+
+    summary_prompt = """
+        Summarize the conversation between the user and the assistant below in a few sentences. 
+        Keep facts about the user, their feelings and the topics that are still open. 
+        Write the summary in the language of the conversation.
+    """
+
+    async def rotate_if_needed(self, tg_user_id: int) -> Optional[str]:
+        user = await requests.get_user_by_telegram_id(telegram_id=tg_user_id)
+        if not user.thread_id or not self._is_thread_too_long(user):
+            return
+        run_state = AssistantRunStateStore()
+        try:
+            # a message answered in the old thread while it is summarized would be lost with it
+            async with run_state.lease(user.thread_id, wait_seconds=0):
+                return await self._rotate(tg_user_id=tg_user_id, thread_id=user.thread_id, run_state=run_state)
+        except RunLeaseTimeoutError:
+            logging.info(f"Thread {user.thread_id} of user {tg_user_id} is busy, rotation is postponed")
+
+    async def _rotate(self, tg_user_id: int, thread_id: str, run_state: AssistantRunStateStore) -> Optional[str]:
+        user = await requests.get_user_by_telegram_id(telegram_id=tg_user_id)
+        if user.thread_id != thread_id:
+            return
+        if await run_state.get(thread_id):
+            # an interrupted run is resumed in the old thread first
+            return
+        summary = await self._summarize_thread(thread_id=thread_id)
+        new_thread = await self._request(
+            "assistants",
+            self.client.beta.threads.create,
+            idempotent=False,
+            messages=[{"role": "assistant", "content": self._get_initial_message(summary, user.values)}]
+        )
+        replaced = await requests.replace_user_thread(
+            user_pk=user.id,
+            old_thread_id=thread_id,
+            new_thread_id=new_thread.id
+        )
+        if not replaced:
+            await self._request("assistants", self.client.beta.threads.delete, thread_id=new_thread.id)
+            return
+        logging.info(f"Thread {thread_id} of user {tg_user_id} was replaced with {new_thread.id}")
+        try:
+            await self._request("assistants", self.client.beta.threads.delete, thread_id=thread_id)
+        except Exception as e:
+            logging.warning(f"Failed to delete replaced thread {thread_id}: {e}")
+        return new_thread.id
+
+    def _is_thread_too_long(self, user) -> bool:
+        return user.thread_message_count >= self.MAX_THREAD_MESSAGES or user.thread_tokens >= self.MAX_THREAD_TOKENS
+
+    async def _summarize_thread(self, thread_id: str) -> str:
+        messages = await self._request(
+            "assistants",
+            self.client.beta.threads.messages.list,
+            thread_id=thread_id,
+            order="desc",
+            limit=self.SUMMARY_MESSAGES_LIMIT
+        )
+        # threads created before usage tracking can be much longer, only the recent context is kept
+        conversation = "\n".join(
+            f"{message.role}: {content.text.value}"
+            for message in reversed(messages.data)
+            for content in message.content
+            if content.type == "text"
+        )
+        response = await self._request(
+            "chat",
+            self.client.chat.completions.create,
+            model=self.model,
+            temperature=0.3,
+            messages=[
+                {"role": "system", "content": self.summary_prompt},
+                {"role": "user", "content": conversation},
+            ]
+        )
+        return response.choices[0].message.content
+
+    @staticmethod
+    def _get_initial_message(summary: str, values: Optional[list[str]]) -> str:
+        message = f"Summary of our previous conversation: {summary}"
+        if values:
+            message += f"\nUser's key values found so far: {', '.join(values)}"
+        return message
+
+
 class VoiceToTextOpenAIService(mixins.OpenAIClientMixin, mixins.SaveFileLocallyMixin):
     """Сервис переводит сообщение из голоса в текст"""
 
-    model = "whisper-1"
+    language = "ru"
+
+    def __init__(self, *args, transcription_cache: Optional[TranscriptionCache] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transcription_cache = transcription_cache or TranscriptionCache()
 
     async def voice_to_text(self, message: aiogram_types.Message) -> str:
+        voice = message.voice
+        text = await self.transcription_cache.get(file_unique_id=voice.file_unique_id, duration=voice.duration)
+        if text is not None:
+            return text
+        text = await self._transcribe(message=message)
+        await self.transcription_cache.save(file_unique_id=voice.file_unique_id, duration=voice.duration, text=text)
+        return text
+
+    async def _transcribe(self, message: aiogram_types.Message) -> str:
         voice_local_path = await self._save_file_to_storage(message=message, type_of_file="voice")
-        transcription_message = await self._openai_voice_to_text(voice_message_path=voice_local_path)
-        return transcription_message
-
-    async def _openai_voice_to_text(self, voice_message_path) -> str:
-        with open(voice_message_path, "rb") as voice_file:
-            transcription = await self.client.audio.transcriptions.create(
-                model=self.model,
-                language="ru",
-                file=voice_file
-            )
-        return transcription.text
+        backends = self._get_backends(duration=message.voice.duration)
+        for backend in backends:
+            try:
+                return await backend.transcribe(voice_path=voice_local_path, language=self.language)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    container.disable_local_whisper()
+                if backend is backends[-1]:
+                    raise
+                logging.warning(f"Transcription with `{backend.name}` backend failed, trying the next one: {e!r}")
+
+    def _get_backends(self, duration: int) -> list[transcription.TranscriptionBackend]:
+        remote = transcription.OpenAIWhisperBackend(client=self.client)
+        if not container.is_local_whisper_enabled:
+            return [remote]
+        local = transcription.LocalWhisperBackend(
+            executor=container.local_whisper_executor,
+            max_in_flight=config.local_whisper_workers,
+            timeout=transcription.LocalWhisperBackend.get_timeout(duration)
+        )
+        if not local.is_available:
+            # every worker is busy, queueing behind them would only burn the timeout
+            return [remote]
+        # short clips are faster to recognize locally than to upload
+        if duration <= config.local_whisper_max_duration or not remote.is_available:
+            return [local, remote]
+        return [remote, local]
 
 
 class TextToVoiceOpenAIService(mixins.OpenAIClientMixin):
     """Сервис переводит текст в .ogg файл"""
 
     model = "tts-1"
+    voice = "nova"
 
     _generated_filename: str
 
+    def __init__(self, *args, voice_cache: Optional[VoiceAssetCache] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.voice_cache = voice_cache or VoiceAssetCache()
+
+    async def answer_voice(self, message: aiogram_types.Message, text: str):
+        """Отвечает голосом, повторяющиеся тексты отправляются по file_id без озвучки и загрузки"""
+        file_id = await self.voice_cache.get_file_id(text=text, voice=self.voice, model=self.model)
+        if file_id:
+            try:
+                await message.answer_voice(file_id)
+                return
+            except TelegramBadRequest as e:
+                logging.warning(f"Cached voice {file_id} was rejected by Telegram: {e}")
+                await self.voice_cache.delete(text=text, voice=self.voice, model=self.model)
+        ogg_voice = await self.text_to_voice(text=text)
+        sent_message = await message.answer_voice(ogg_voice)
+        await self.voice_cache.save_file_id(
+            text=text,
+            voice=self.voice,
+            model=self.model,
+            file_id=sent_message.voice.file_id
+        )
+
     async def text_to_voice(self, text: str) -> aiogram_types.BufferedInputFile:
-        voice = await self.client.audio.speech.create(
+        voice = await self._request(
+            "tts",
+            self.client.audio.speech.create,
             model=self.model,
-            voice="nova",
+            voice=self.voice,
             input=text
         )
         mp3_path = self._save_mp3_to_storage(voice=voice)
@@ -232,6 +547,18 @@ class TextToVoiceOpenAIService(mixins.OpenAIClientMixin):
 class UserValueOpenAIValidator(mixins.OpenAIClientMixin):
     """Сервис для валидации ценности пользователя"""
 
+    # validation runs in the background of a voice answer and must not eat the user-facing budget
+    priority = Priority.BACKGROUND
+
+    async def validate_and_save(self, context: str, tool_outputs: list[dict], tg_user_id: int):
+        values = [output["output"] for output in tool_outputs]
+        validated_values = []
+        for value in values:
+            is_valid = await self.is_valid(context=context, value_to_validate=value, telegram_id=tg_user_id)
+            if is_valid:
+                validated_values.append(value)
+        await requests.update_user_values(telegram_id=tg_user_id, values=validated_values)
+
     async def is_valid(self, context: str, value_to_validate: str, telegram_id: int, ):
         validation_result = await self._send_openai_request(
             context=context,
@@ -241,7 +568,9 @@ class UserValueOpenAIValidator(mixins.OpenAIClientMixin):
         return validation_result == "true"
 
     async def _send_openai_request(self, context: str, value_to_validate: str, telegram_id: int) -> str:
-        response = await self.client.chat.completions.create(
+        response = await self._request(
+            "chat",
+            self.client.chat.completions.create,
             model=self.model,
             temperature=0.3,
             messages=[
@@ -310,7 +639,9 @@ class ImageRecognitionService(mixins.OpenAIClientMixin, mixins.SaveFileLocallyMi
     async def recognize_mood_by_photo(self, message: aiogram_types.Message):
         photo_local_path = await self._save_file_to_storage(message=message, type_of_file="photo")
         base64_image = utils.encode_image(photo_local_path)
-        response = await self.client.chat.completions.create(
+        response = await self._request(
+            "vision",
+            self.client.chat.completions.create,
             model=self.model,
             temperature=0.3,
             messages=[
@@ -383,18 +714,27 @@ class AssistantFileSearch(mixins.OpenAIClientMixin):
             existing_tools=existing_tools,
             vector_store_id=vector_store.id
         )
-        assistant = await self.client.beta.assistants.update(
+        assistant = await self._request(
+            "assistants",
+            self.client.beta.assistants.update,
             assistant_id=self.assistant_id,
             **tool_parameters
         )
         return assistant
 
     async def _create_vector_store(self, name: str, tg_user_id: int) -> VectorStore:
-        vector_store = await self.client.beta.vector_stores.create(name=name)
+        vector_store = await self._request(
+            "assistants",
+            self.client.beta.vector_stores.create,
+            idempotent=False,
+            name=name
+        )
         file_paths = [os.path.join(config.documents_file_search_dir, file_name) for file_name in self._file_names]
         file_streams = [open(path, "rb") for path in file_paths]
 
-        await self.client.beta.vector_stores.file_batches.upload_and_poll(
+        await self._request(
+            "vector_stores",
+            self.client.beta.vector_stores.file_batches.upload_and_poll,
             vector_store_id=vector_store.id,
             files=file_streams
         )
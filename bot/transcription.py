@@ -0,0 +1,105 @@
+import asyncio
+import importlib.util
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+from concurrent.futures import Executor
+
+import mixins
+import resilience
+
+
+class TranscriptionBackend(ABC):
+    """Движок распознавания голоса"""
+
+    name: str
+
+    @abstractmethod
+    async def transcribe(self, voice_path: str, language: str) -> str:
+        ...
+
+
+class OpenAIWhisperBackend(mixins.OpenAIClientMixin, TranscriptionBackend):
+    """Распознавание через whisper-1 в OpenAI API"""
+
+    name = "openai"
+    model = "whisper-1"
+
+    @property
+    def is_available(self) -> bool:
+        return not resilience.breakers["whisper"].is_open
+
+    async def transcribe(self, voice_path: str, language: str) -> str:
+        with open(voice_path, "rb") as voice_file:
+            # read upfront so that a retried request uploads the whole file again
+            voice_content = voice_file.read()
+        transcription = await self._request(
+            "whisper",
+            self.client.audio.transcriptions.create,
+            model=self.model,
+            language=language,
+            file=(os.path.basename(voice_path), voice_content)
+        )
+        return transcription.text
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """Распознавание квантованной моделью faster-whisper на CPU в пуле процессов"""
+
+    name = "local"
+
+    TIMEOUT_BASE_SECONDS = 5
+    TIMEOUT_PER_AUDIO_SECOND = 1.0
+
+    # jobs submitted to the pool and not finished yet, shared by all instances of the process
+    in_flight = 0
+
+    def __init__(self, executor: Executor, max_in_flight: int, timeout: Optional[float] = None):
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+
+    @property
+    def is_available(self) -> bool:
+        return LocalWhisperBackend.in_flight < self.max_in_flight
+
+    @classmethod
+    def get_timeout(cls, duration: int) -> float:
+        return cls.TIMEOUT_BASE_SECONDS + duration * cls.TIMEOUT_PER_AUDIO_SECOND
+
+    async def transcribe(self, voice_path: str, language: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(transcribe_locally, voice_path, language)
+        LocalWhisperBackend.in_flight += 1
+        # a timed out job keeps its worker busy until it is done, so it is counted until then
+        future.add_done_callback(lambda _: _call_soon_threadsafe(loop, _release_local_worker))
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+
+
+def _release_local_worker():
+    LocalWhisperBackend.in_flight -= 1
+
+
+def _call_soon_threadsafe(loop: asyncio.AbstractEventLoop, callback):
+    # the pool can finish its last jobs after the bot has stopped
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(callback)
+
+
+def is_local_whisper_installed() -> bool:
+    return importlib.util.find_spec("faster_whisper") is not None
+
+
+_local_model = None
+
+
+def init_local_model(model_name: str, cpu_threads: int):
+    """Инициализатор процесса пула: модель загружается один раз на процесс"""
+    global _local_model
+    from faster_whisper import WhisperModel
+    _local_model = WhisperModel(model_name, device="cpu", compute_type="int8", cpu_threads=cpu_threads)
+
+
+def transcribe_locally(voice_path: str, language: str) -> str:
+    segments, _ = _local_model.transcribe(voice_path, language=language, beam_size=1, vad_filter=True)
+    return "".join(segment.text for segment in segments).strip()
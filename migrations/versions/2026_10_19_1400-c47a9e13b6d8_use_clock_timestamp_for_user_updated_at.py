@@ -0,0 +1,39 @@
+"""use clock_timestamp for user updated_at
+
+Revision ID: c47a9e13b6d8
+Revises: 8d1e6a0c5f2b
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c47a9e13b6d8"
+down_revision: Union[str, None] = "8d1e6a0c5f2b"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.alter_column(
+        "user",
+        "updated_at",
+        server_default=sa.text("clock_timestamp()"),
+        existing_type=sa.DateTime(timezone=True),
+        existing_nullable=False,
+    )
+
+
+def downgrade() -> None:
+    op.alter_column(
+        "user",
+        "updated_at",
+        server_default=sa.text("now()"),
+        existing_type=sa.DateTime(timezone=True),
+        existing_nullable=False,
+    )
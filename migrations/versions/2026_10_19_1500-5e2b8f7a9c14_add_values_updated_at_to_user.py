@@ -0,0 +1,45 @@
+"""add values_updated_at to user
+
+Revision ID: 5e2b8f7a9c14
+Revises: c47a9e13b6d8
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5e2b8f7a9c14"
+down_revision: Union[str, None] = "c47a9e13b6d8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "user",
+        sa.Column(
+            "values_updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("clock_timestamp()"),
+            nullable=False,
+        ),
+    )
+    # users already exported keep their place relative to the saved watermarks
+    op.execute('UPDATE "user" SET values_updated_at = updated_at')
+    op.create_index(
+        op.f("ix_user_values_updated_at"), "user", ["values_updated_at"], unique=False
+    )
+    op.drop_index(op.f("ix_user_updated_at"), table_name="user")
+
+
+def downgrade() -> None:
+    op.create_index(
+        op.f("ix_user_updated_at"), "user", ["updated_at"], unique=False
+    )
+    op.drop_index(op.f("ix_user_values_updated_at"), table_name="user")
+    op.drop_column("user", "values_updated_at")